@@ -1,38 +1,80 @@
 import asyncio
 import sys
-import threading
 import time
-import json
 import os
-from typing import Optional
-from contextlib import AsyncExitStack
-import nest_asyncio
-
-# Apply nest_asyncio to allow nested event loops
-nest_asyncio.apply()
+import hashlib
+import sqlite3
+from typing import AsyncIterator, Optional
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractAsyncContextManager, AsyncExitStack
 
 import gradio as gr
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
+from mcp.types import TextContent
 
+import aiohttp
 import openai
+import orjson
 from dotenv import load_dotenv
 
+# Prefer uvloop's libuv-based event loop when it is available
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 # Load environment variables
 dotenv_path = os.getenv('DOTENV_PATH', '.env')
 load_dotenv(dotenv_path)
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-# Create a global event loop
-event_loop = asyncio.new_event_loop()
-asyncio.set_event_loop(event_loop)
+# Persistent tier of the ChatCompletion response cache
+CACHE_PATH = os.getenv("OPENAI_CACHE_PATH", ".openai_cache.sqlite")
+
+# Queries longer than this are rejected without calling OpenAI
+MAX_QUERY_LEN = 2000
+# Seconds a failed query keeps returning its error instead of retrying
+ERROR_TTL = 30
+# Completion cap per request; a capped answer is continued once
+MAX_TOKENS = 256
+
+# Sent after a capped answer; Chat Completions does not extend a trailing assistant turn
+CONTINUE_PROMPT = "Continue exactly where you stopped, without repeating anything."
 
-class MCPClient:
+def _continuation(messages: list, partial: str) -> list:
+    """Return messages extended with the capped answer and a request for the rest."""
+    return messages + [
+        {"role": "assistant", "content": partial},
+        {"role": "user", "content": CONTINUE_PROMPT},
+    ]
+
+@lru_cache(maxsize=8)
+def _functions_json(tools: tuple[tuple[str, str, bytes], ...]) -> bytes:
+    """Serialize (name, description, schema JSON) triples as an OpenAI functions array."""
+    return orjson.dumps([
+        {"name": name, "description": description, "parameters": orjson.loads(schema)}
+        for name, description, schema in tools
+    ], option=orjson.OPT_SORT_KEYS)
+
+class MCPClient(AbstractAsyncContextManager):
     def __init__(self):
         self.session: Optional[ClientSession] = None
         self.exit_stack = AsyncExitStack()
         self.server_connected = False
         self.tools = []
+        self._functions_cache: list | None = None
+        self._functions_hash: str | None = None
+        self._chat_cache: dict = {}
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._recent_errors: dict[str, tuple[float, str]] = {}
+        self._http: aiohttp.ClientSession | None = None
+        self._cache_db = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        self._cache_db.execute("CREATE TABLE IF NOT EXISTS chat_cache (key TEXT PRIMARY KEY, value TEXT)")
+        # All SQLite I/O runs on this one worker, off the event loop and serialized
+        self._cache_io = ThreadPoolExecutor(max_workers=1)
 
     async def connect_to_server(self, server_script_path: str) -> str:
         try:
@@ -52,99 +94,270 @@ class MCPClient:
 
             resp = await self.session.list_tools()
             self.tools = resp.tools
+            # Serialize once with stable key order so every request sends identical bytes
+            functions_json = _functions_json(tuple(
+                (t.name, t.description, orjson.dumps(t.inputSchema, option=orjson.OPT_SORT_KEYS))
+                for t in self.tools
+            ))
+            self._functions_cache = orjson.loads(functions_json)
+            self._functions_hash = hashlib.blake2b(functions_json).hexdigest()
             self.server_connected = True
             info = [f"{t.name}: {t.description}" for t in self.tools]
             return "✅ Connected with tools:\n" + "\n".join(info)
         except Exception as e:
             return f"❌ Connection error: {e}"
 
-    async def process_query(self, query: str) -> str:
+    def _bind_http_session(self):
+        # openai 0.28 sends requests through the aiohttp session in openai.aiosession
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=20, keepalive_timeout=60)
+            )
+        openai.aiosession.set(self._http)
+
+    def _cache_key(self, kwargs: dict) -> str | None:
+        # Only replay deterministic requests; sampled ones (the API default
+        # temperature is 1) must hit the API
+        if kwargs.get("temperature", 1) != 0:
+            return None
+        if kwargs.get("functions") is self._functions_cache:
+            # Stand in the precomputed hash for the (large) function schemas
+            kwargs = {**kwargs, "functions": self._functions_hash}
+        return hashlib.blake2b(orjson.dumps(kwargs, option=orjson.OPT_SORT_KEYS, default=str)).hexdigest()
+
+    async def _cache_get(self, key: str) -> dict | None:
+        cached = self._chat_cache.get(key)
+        if cached is None:
+            row = await asyncio.get_running_loop().run_in_executor(self._cache_io, self._db_get, key)
+            if row:
+                cached = self._chat_cache[key] = orjson.loads(row[0])
+        return cached
+
+    def _cache_put(self, key: str, value: dict):
+        self._chat_cache[key] = value
+        # Persist in the background; the in-memory tier already serves hits
+        asyncio.get_running_loop().run_in_executor(self._cache_io, self._db_put, key, orjson.dumps(value))
+
+    def _db_get(self, key: str):
+        return self._cache_db.execute("SELECT value FROM chat_cache WHERE key = ?", (key,)).fetchone()
+
+    def _db_put(self, key: str, value: bytes):
+        self._cache_db.execute("INSERT OR REPLACE INTO chat_cache VALUES (?, ?)", (key, value))
+        self._cache_db.commit()
+
+    async def _cached_chat(self, **kwargs):
+        key = self._cache_key(kwargs)
+        cached = await self._cache_get(key) if key else None
+        if cached is None:
+            self._bind_http_session()
+            resp = await openai.ChatCompletion.acreate(**kwargs)
+            cached = resp.to_dict_recursive()
+            if key:
+                self._cache_put(key, cached)
+        return openai.util.convert_to_openai_object(cached)
+
+    async def _cached_stream(self, *, continue_capped: bool = True, **kwargs):
+        # Streamed counterpart of _cached_chat; a cache hit is replayed in one piece.
+        # continue_capped=False when the caller's request is itself a continuation
+        kwargs["stream"] = True
+        key = self._cache_key(kwargs)
+        cached = await self._cache_get(key) if key else None
+        if cached is not None:
+            yield cached["content"]
+            return
+        pieces = []
+        self._bind_http_session()
+        messages = kwargs["messages"]
+        for _ in range(2 if continue_capped else 1):  # the request plus at most one continuation
+            finish_reason = None
+            async for chunk in await openai.ChatCompletion.acreate(**kwargs):
+                choice = chunk.choices[0]
+                delta = choice.delta.get("content", "")
+                if delta:
+                    pieces.append(delta)
+                    yield delta
+                finish_reason = choice.get("finish_reason") or finish_reason
+            if finish_reason != "length":
+                break
+            # The answer legitimately outgrew max_tokens; pick up where it stopped
+            kwargs = {**kwargs, "messages": _continuation(messages, "".join(pieces))}
+        if key:
+            self._cache_put(key, {"content": "".join(pieces)})
+
+    def _record_error(self, query: str, error: str):
+        now = time.monotonic()
+        # Drop expired entries on insert so the map only holds live errors
+        self._recent_errors = {q: v for q, v in self._recent_errors.items() if v[0] > now}
+        self._recent_errors[query] = (now + ERROR_TTL, error)
+
+    def _direct_response(self, query: str) -> str | None:
+        # Cheap checks that answer trivial or malformed queries without OpenAI
+        if len(query) < 2 or query.isdigit():
+            return "Please ask a weather question, e.g. \"Any alerts in CA?\""
+        if len(query) > MAX_QUERY_LEN:
+            return f"Please keep questions under {MAX_QUERY_LEN} characters."
+        recent = self._recent_errors.get(query)
+        if recent is not None:
+            expires, error = recent
+            if expires > time.monotonic():
+                return error
+            del self._recent_errors[query]
+        return None
+
+    async def process_query(self, query: str) -> AsyncIterator[str]:
+        """Yield the answer to query piece by piece as it is generated.
+
+        Trivial queries and recent failures are answered directly, and
+        concurrent identical queries share a single backend call.
+        """
+        query = query.strip()
+        direct = self._direct_response(query)
+        if direct is not None:
+            yield direct
+            return
+        key = hashlib.blake2b(query.encode()).hexdigest()
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            # An identical query is already running; share its answer
+            shared = await asyncio.shield(inflight)
+            if shared is not None:
+                yield shared
+                return
+            # Its leader stopped early; retry, so one of the waiting followers leads
+            async for piece in self.process_query(query):
+                yield piece
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        pieces = []
+        try:
+            async for piece in self._answer(query):
+                pieces.append(piece)
+                yield piece
+        except Exception as e:
+            fut.set_exception(e)
+            # Mark it retrieved so a future no follower joined is not logged
+            fut.exception()
+            raise
+        else:
+            fut.set_result("".join(pieces))
+        finally:
+            self._inflight.pop(key, None)
+            if not fut.done():
+                # The leader stopped early; None sends followers to answer it themselves
+                fut.set_result(None)
+
+    async def _answer(self, query: str) -> AsyncIterator[str]:
         if not self.server_connected or not self.session:
-            return "❌ Not connected."
+            yield "❌ Not connected."
+            return
         try:
-            # Prepare function definitions
-            resp = await self.session.list_tools()
-            functions = [
-                {"name": t.name, "description": t.description, "parameters": t.inputSchema}
-                for t in resp.tools
-            ]
+            # Function definitions are cached at connect time
+            functions = self._functions_cache
 
             # Call OpenAI ChatCompletion
-            chat_resp = await openai.ChatCompletion.acreate(
+            chat_resp = await self._cached_chat(
                 model="gpt-4o-mini",
+                temperature=0,
                 messages=[{"role": "user", "content": query}],
                 functions=functions,
-                function_call="auto"
+                function_call="auto",
+                max_tokens=MAX_TOKENS
             )
-            msg = chat_resp.choices[0].message
+            choice = chat_resp.choices[0]
+            msg = choice.message
 
             # If function call requested
             if msg.function_call:
                 fn_name = msg.function_call.name
-                args = json.loads(msg.function_call.arguments or "{}")
+                args = orjson.loads(msg.function_call.arguments or "{}")
                 tool_res = await self.session.call_tool(fn_name, args)
 
                 # Normalize tool output to string
                 raw_content = tool_res.content
                 if isinstance(raw_content, list):
-                    # extract text from any TextContent-like items
-                    pieces = []
-                    for item in raw_content:
-                        # item may have .text or .content
-                        text = getattr(item, 'text', None) or getattr(item, 'content', None) or str(item)
-                        pieces.append(text)
-                    normalized = "\n".join(pieces)
+                    # TextContent takes the fast path; other items may have .text or .content
+                    normalized = "\n".join([
+                        i.text if isinstance(i, TextContent)
+                        else getattr(i, 'text', None) or getattr(i, 'content', None) or str(i)
+                        for i in raw_content
+                    ])
                 elif hasattr(raw_content, 'content'):
                     normalized = raw_content.content
                 else:
                     normalized = str(raw_content)
 
-                # second ChatCompletion with function result
-                follow = await openai.ChatCompletion.acreate(
+                # second ChatCompletion with function result, streamed; it resends the
+                # same functions so OpenAI's prompt cache can reuse the first call's prefix
+                async for piece in self._cached_stream(
                     model="gpt-4o-mini",
+                    temperature=0,
                     messages=[
                         {"role":"user","content":query},
                         {"role":"assistant","function_call":msg.function_call.to_dict()},
                         {"role":"function","name":fn_name,"content": normalized}
-                    ]
-                )
-                return follow.choices[0].message.content or ""
+                    ],
+                    functions=functions,
+                    function_call="none",
+                    max_tokens=MAX_TOKENS
+                ):
+                    yield piece
+                return
 
-            return msg.content or ""
+            yield msg.content or ""
+            if choice.finish_reason == "length":
+                # Direct answer was capped; stream the rest of it
+                async for piece in self._cached_stream(
+                    model="gpt-4o-mini",
+                    temperature=0,
+                    messages=_continuation([{"role":"user","content":query}], msg.content),
+                    functions=functions,
+                    function_call="none",
+                    max_tokens=MAX_TOKENS,
+                    continue_capped=False
+                ):
+                    yield piece
         except Exception as e:
-            return f"❌ Error: {e}"
+            error = f"❌ Error: {e}"
+            self._record_error(query, error)
+            yield error
+
+    async def __aexit__(self, *exc):
+        await self.cleanup()
 
     async def cleanup(self):
         if self.session:
             await self.exit_stack.aclose()
+            # A closed stack must not be reused by the next connect
+            self.exit_stack = AsyncExitStack()
             self.server_connected = False
             self.session = None
+            self._functions_cache = None
+            self._functions_hash = None
+        # Errors from the old server must not outlive it
+        self._recent_errors.clear()
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
 
 # Instantiate client
 client = MCPClient()
 
-def run_async(coro):
-    return asyncio.run_coroutine_threadsafe(coro, event_loop).result()
-
-# Gradio callbacks
-def connect(server_path):
-    return run_async(client.connect_to_server(server_path))
-def disconnect():
-    run_async(client.cleanup())
+# Gradio callbacks (awaited on Gradio's own event loop)
+async def connect(server_path):
+    return await client.connect_to_server(server_path)
+async def disconnect():
+    await client.cleanup()
     return "Disconnected"
 
-def chat(query, history):
+async def chat(query, history):
     history = history or []
     history.append({"role": "user", "content": query})
-    resp = run_async(client.process_query(query))
-    history.append({"role": "assistant", "content": resp})
-    return history
-
-# Start event loop thread
-def start_loop():
-    asyncio.set_event_loop(event_loop)
-    event_loop.run_forever()
-threading.Thread(target=start_loop, daemon=True).start()
+    history.append({"role": "assistant", "content": ""})
+    yield history
+    async for piece in client.process_query(query):
+        history[-1]["content"] += piece
+        yield history
 
 with gr.Blocks() as demo:
     gr.Markdown("# MCP Weather Client (OpenAI)")
@@ -1,26 +1,92 @@
 # weather-client-gpt.py
 import sys
 import asyncio
-import json
+import threading
+import hashlib
+import sqlite3
 from typing import Optional
-from contextlib import AsyncExitStack
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractAsyncContextManager, AsyncExitStack
 
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
 import os
+import aiohttp
 import openai
+import orjson
 from dotenv import load_dotenv
 
+# Prefer uvloop's libuv-based event loop when it is available
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 load_dotenv()  # load OPENAI_API_KEY from .env
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-class MCPClient:
+# Persistent tier of the ChatCompletion response cache
+CACHE_PATH = os.getenv("OPENAI_CACHE_PATH", ".openai_cache.sqlite")
+
+# Completion cap per request; a capped answer is continued once
+MAX_TOKENS = 256
+
+# Sent after a capped answer; Chat Completions does not extend a trailing assistant turn
+CONTINUE_PROMPT = "Continue exactly where you stopped, without repeating anything."
+
+def _continuation(messages: list, partial: str) -> list:
+    """Return messages extended with the capped answer and a request for the rest."""
+    return messages + [
+        {"role": "assistant", "content": partial},
+        {"role": "user", "content": CONTINUE_PROMPT},
+    ]
+
+async def ainput(prompt: str) -> str:
+    """Await a line from stdin without blocking the event loop.
+
+    Reads on a daemon thread rather than asyncio.to_thread: interpreter
+    shutdown never joins it, so Ctrl-C exits without waiting for Enter.
+    """
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+
+    def settle(method, value):
+        if not fut.done():
+            method(value)
+
+    def read():
+        try:
+            line = input(prompt)
+        except BaseException as e:
+            result = (fut.set_exception, e)
+        else:
+            result = (fut.set_result, line)
+        try:
+            loop.call_soon_threadsafe(settle, *result)
+        except RuntimeError:
+            pass  # the loop already closed
+
+    threading.Thread(target=read, daemon=True).start()
+    return await fut
+
+class MCPClient(AbstractAsyncContextManager):
     def __init__(self):
         self.session: Optional[ClientSession] = None
         self.exit_stack = AsyncExitStack()
+        self.tools = []
+        self._functions_cache: list | None = None
+        self._http: aiohttp.ClientSession | None = None
+        self._chat_cache: dict = {}
+        self._cache_db = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        self._cache_db.execute("CREATE TABLE IF NOT EXISTS chat_cache (key TEXT PRIMARY KEY, value TEXT)")
+        # All SQLite I/O runs on this one worker, off the event loop and serialized
+        self._cache_io = ThreadPoolExecutor(max_workers=1)
 
     async def connect_to_server(self, server_script_path: str):
+        if self.session:
+            await self.cleanup()
         is_py = server_script_path.endswith('.py')
         is_js = server_script_path.endswith('.js')
         if not (is_py or is_js):
@@ -36,40 +102,88 @@ class MCPClient:
         await self.session.initialize()
 
         resp = await self.session.list_tools()
-        print("Connected to server with tools:", [t.name for t in resp.tools])
-
-    async def process_query(self, query: str) -> str:
-        # 1) fetch tool definitions
-        resp = await self.session.list_tools()
-        functions = [
+        self.tools = resp.tools
+        self._functions_cache = [
             {"name": t.name, "description": t.description, "parameters": t.inputSchema}
-            for t in resp.tools
+            for t in self.tools
         ]
+        print("Connected to server with tools:", [t.name for t in self.tools])
+
+    def _cache_key(self, kwargs: dict) -> str | None:
+        # Only replay deterministic requests; sampled ones (the API default
+        # temperature is 1) must hit the API
+        if kwargs.get("temperature", 1) != 0:
+            return None
+        return hashlib.blake2b(orjson.dumps(kwargs, option=orjson.OPT_SORT_KEYS, default=str)).hexdigest()
+
+    async def _cache_get(self, key: str) -> dict | None:
+        cached = self._chat_cache.get(key)
+        if cached is None:
+            row = await asyncio.get_running_loop().run_in_executor(self._cache_io, self._db_get, key)
+            if row:
+                cached = self._chat_cache[key] = orjson.loads(row[0])
+        return cached
+
+    def _cache_put(self, key: str, value: dict):
+        self._chat_cache[key] = value
+        # Persist in the background; the in-memory tier already serves hits
+        asyncio.get_running_loop().run_in_executor(self._cache_io, self._db_put, key, orjson.dumps(value))
+
+    def _db_get(self, key: str):
+        return self._cache_db.execute("SELECT value FROM chat_cache WHERE key = ?", (key,)).fetchone()
+
+    def _db_put(self, key: str, value: bytes):
+        self._cache_db.execute("INSERT OR REPLACE INTO chat_cache VALUES (?, ?)", (key, value))
+        self._cache_db.commit()
+
+    def _bind_http_session(self):
+        # openai 0.28 sends requests through the aiohttp session in openai.aiosession
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=20, keepalive_timeout=60)
+            )
+        openai.aiosession.set(self._http)
+
+    async def _cached_chat(self, **kwargs):
+        key = self._cache_key(kwargs)
+        cached = await self._cache_get(key) if key else None
+        if cached is None:
+            self._bind_http_session()
+            resp = await openai.ChatCompletion.acreate(**kwargs)
+            cached = resp.to_dict_recursive()
+            if key:
+                self._cache_put(key, cached)
+        return openai.util.convert_to_openai_object(cached)
+
+    async def process_query(self, query: str) -> str:
+        # 1) tool definitions are cached at connect time
+        functions = self._functions_cache
 
         # 2) initial user message
         messages = [{"role": "user", "content": query}]
 
         # 3) ask GPT
-        completion = await openai.ChatCompletion.acreate(
+        completion = await self._cached_chat(
             model="gpt-4o-mini",
+            temperature=0,
             messages=messages,
             functions=functions,
             function_call="auto",
-            max_tokens=1000
+            max_tokens=MAX_TOKENS
         )
         msg = completion.choices[0].message
 
         if msg.get("function_call"):
             # 4) execute the requested tool
             fn = msg.function_call.name
-            args = json.loads(msg.function_call.arguments or "{}")
+            args = orjson.loads(msg.function_call.arguments or "{}")
             tool_resp = await self.session.call_tool(fn, args)
 
             # 5) serialize the tool output
             content = tool_resp.content
             if hasattr(content, "text"):
                 content = content.text
-            raw = json.dumps(content) if isinstance(content, (list, dict)) else str(content)
+            raw = orjson.dumps(content).decode() if isinstance(content, (list, dict)) else str(content)
 
             # 6) append the assistant’s function_call as a pure dict
             messages.append({
@@ -85,20 +199,34 @@ class MCPClient:
             messages.append({"role": "function", "name": fn, "content": raw})
 
             # 8) get GPT’s final answer
-            followup = await openai.ChatCompletion.acreate(
+            followup = await self._cached_chat(
                 model="gpt-4o-mini",
+                temperature=0,
                 messages=messages,
-                max_tokens=1000
+                max_tokens=MAX_TOKENS
             )
-            return followup.choices[0].message.content or ""
+            return await self._continue_if_capped(messages, followup.choices[0])
 
         # no function call: just return the assistant’s reply
-        return msg.content or ""
+        return await self._continue_if_capped(messages, completion.choices[0])
+
+    async def _continue_if_capped(self, messages, choice) -> str:
+        content = choice.message.content or ""
+        if choice.finish_reason != "length":
+            return content
+        # The answer outgrew MAX_TOKENS; ask once for the rest
+        more = await self._cached_chat(
+            model="gpt-4o-mini",
+            temperature=0,
+            messages=_continuation(messages, content),
+            max_tokens=MAX_TOKENS
+        )
+        return content + (more.choices[0].message.content or "")
 
     async def chat_loop(self):
         print("MCP GPT-Client started. Type ‘quit’ to exit.")
         while True:
-            q = input("Query: ").strip()
+            q = (await ainput("Query: ")).strip()
             if q.lower() == "quit":
                 break
             try:
@@ -106,19 +234,26 @@ class MCPClient:
             except Exception as e:
                 print("Error:", e)
 
+    async def __aexit__(self, *exc):
+        await self.cleanup()
+
     async def cleanup(self):
         await self.exit_stack.aclose()
+        # A closed stack must not be reused by the next connect
+        self.exit_stack = AsyncExitStack()
+        self.session = None
+        self._functions_cache = None
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
 
 async def main():
     if len(sys.argv) < 2:
         print("Usage: python weather-client-gpt.py <path_to_server_script>")
         sys.exit(1)
-    c = MCPClient()
-    try:
+    async with MCPClient() as c:
         await c.connect_to_server(sys.argv[1])
         await c.chat_loop()
-    finally:
-        await c.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
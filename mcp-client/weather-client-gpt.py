@@ -1,27 +1,87 @@
 import asyncio
-import json
+import hashlib
+import sqlite3
+import time
 import threading
 import queue
 import os
 import sys
-from contextlib import AsyncExitStack
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractAsyncContextManager, AsyncExitStack
+from typing import AsyncIterator
 import tkinter as tk
 from tkinter import scrolledtext, filedialog, messagebox
 
+import aiohttp
 import openai
+import orjson
 from dotenv import load_dotenv
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 
+# Prefer uvloop's libuv-based event loop when it is available
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-class MCPClient:
+# Persistent tier of the ChatCompletion response cache
+CACHE_PATH = os.getenv("OPENAI_CACHE_PATH", ".openai_cache.sqlite")
+
+# Queries longer than this are rejected without calling OpenAI
+MAX_QUERY_LEN = 2000
+# Seconds a failed query keeps returning its error instead of retrying
+ERROR_TTL = 30
+# Completion cap per request; a capped answer is continued once
+MAX_TOKENS = 256
+
+# Queued queries at or above this count are answered concurrently
+BATCH_THRESHOLD = 2
+# Seconds a reconnect waits for the previous session to shut down
+SHUTDOWN_TIMEOUT = 5
+
+# Sent after a capped answer; Chat Completions does not extend a trailing assistant turn
+CONTINUE_PROMPT = "Continue exactly where you stopped, without repeating anything."
+
+def _continuation(messages: list, partial: str) -> list:
+    """Return messages extended with the capped answer and a request for the rest."""
+    return messages + [
+        {"role": "assistant", "content": partial},
+        {"role": "user", "content": CONTINUE_PROMPT},
+    ]
+
+@lru_cache(maxsize=8)
+def _functions_json(tools: tuple[tuple[str, str, bytes], ...]) -> bytes:
+    """Serialize (name, description, schema JSON) triples as an OpenAI functions array."""
+    return orjson.dumps([
+        {"name": name, "description": description, "parameters": orjson.loads(schema)}
+        for name, description, schema in tools
+    ], option=orjson.OPT_SORT_KEYS)
+
+class MCPClient(AbstractAsyncContextManager):
     def __init__(self):
         self.session = None
         self.exit_stack = AsyncExitStack()
+        self.tools = []
+        self._functions_cache: list | None = None
+        self._functions_hash: str | None = None
+        self._chat_cache: dict = {}
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._recent_errors: dict[str, tuple[float, str]] = {}
+        self._http: aiohttp.ClientSession | None = None
+        self._cache_db = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        self._cache_db.execute("CREATE TABLE IF NOT EXISTS chat_cache (key TEXT PRIMARY KEY, value TEXT)")
+        # All SQLite I/O runs on this one worker, off the event loop and serialized
+        self._cache_io = ThreadPoolExecutor(max_workers=1)
 
     async def connect(self, script_path: str):
+        if self.session:
+            await self.cleanup()
         is_py = script_path.endswith('.py')
         is_js = script_path.endswith('.js')
         if not (is_py or is_js):
@@ -34,31 +94,216 @@ class MCPClient:
             ClientSession(self.stdio, self.write)
         )
         await self.session.initialize()
-
-    async def process(self, query: str) -> str:
         resp = await self.session.list_tools()
-        functions = [{"name": t.name, "description": t.description, "parameters": t.inputSchema}
-                     for t in resp.tools]
+        self.tools = resp.tools
+        # Serialize once with stable key order so every request sends identical bytes
+        functions_json = _functions_json(tuple(
+            (t.name, t.description, orjson.dumps(t.inputSchema, option=orjson.OPT_SORT_KEYS))
+            for t in self.tools
+        ))
+        self._functions_cache = orjson.loads(functions_json)
+        self._functions_hash = hashlib.blake2b(functions_json).hexdigest()
+
+    def _bind_http_session(self):
+        # openai 0.28 sends requests through the aiohttp session in openai.aiosession
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=20, keepalive_timeout=60)
+            )
+        openai.aiosession.set(self._http)
+
+    def _cache_key(self, kwargs: dict) -> str | None:
+        # Only replay deterministic requests; sampled ones (the API default
+        # temperature is 1) must hit the API
+        if kwargs.get("temperature", 1) != 0:
+            return None
+        if kwargs.get("functions") is self._functions_cache:
+            # Stand in the precomputed hash for the (large) function schemas
+            kwargs = {**kwargs, "functions": self._functions_hash}
+        return hashlib.blake2b(orjson.dumps(kwargs, option=orjson.OPT_SORT_KEYS, default=str)).hexdigest()
+
+    async def _cache_get(self, key: str) -> dict | None:
+        cached = self._chat_cache.get(key)
+        if cached is None:
+            row = await asyncio.get_running_loop().run_in_executor(self._cache_io, self._db_get, key)
+            if row:
+                cached = self._chat_cache[key] = orjson.loads(row[0])
+        return cached
+
+    def _cache_put(self, key: str, value: dict):
+        self._chat_cache[key] = value
+        # Persist in the background; the in-memory tier already serves hits
+        asyncio.get_running_loop().run_in_executor(self._cache_io, self._db_put, key, orjson.dumps(value))
+
+    def _db_get(self, key: str):
+        return self._cache_db.execute("SELECT value FROM chat_cache WHERE key = ?", (key,)).fetchone()
+
+    def _db_put(self, key: str, value: bytes):
+        self._cache_db.execute("INSERT OR REPLACE INTO chat_cache VALUES (?, ?)", (key, value))
+        self._cache_db.commit()
+
+    async def _cached_chat(self, **kwargs):
+        key = self._cache_key(kwargs)
+        cached = await self._cache_get(key) if key else None
+        if cached is None:
+            self._bind_http_session()
+            resp = await openai.ChatCompletion.acreate(**kwargs)
+            cached = resp.to_dict_recursive()
+            if key:
+                self._cache_put(key, cached)
+        return openai.util.convert_to_openai_object(cached)
+
+    async def _cached_stream(self, *, continue_capped: bool = True, **kwargs):
+        # Streamed counterpart of _cached_chat; a cache hit is replayed in one piece.
+        # continue_capped=False when the caller's request is itself a continuation
+        kwargs["stream"] = True
+        key = self._cache_key(kwargs)
+        cached = await self._cache_get(key) if key else None
+        if cached is not None:
+            yield cached["content"]
+            return
+        pieces = []
+        self._bind_http_session()
+        messages = kwargs["messages"]
+        for _ in range(2 if continue_capped else 1):  # the request plus at most one continuation
+            finish_reason = None
+            async for chunk in await openai.ChatCompletion.acreate(**kwargs):
+                choice = chunk.choices[0]
+                delta = choice.delta.get("content", "")
+                if delta:
+                    pieces.append(delta)
+                    yield delta
+                finish_reason = choice.get("finish_reason") or finish_reason
+            if finish_reason != "length":
+                break
+            # The answer legitimately outgrew max_tokens; pick up where it stopped
+            kwargs = {**kwargs, "messages": _continuation(messages, "".join(pieces))}
+        if key:
+            self._cache_put(key, {"content": "".join(pieces)})
+
+    def _record_error(self, query: str, error: str):
+        now = time.monotonic()
+        # Drop expired entries on insert so the map only holds live errors
+        self._recent_errors = {q: v for q, v in self._recent_errors.items() if v[0] > now}
+        self._recent_errors[query] = (now + ERROR_TTL, error)
+
+    def _direct_response(self, query: str) -> str | None:
+        # Cheap checks that answer trivial or malformed queries without OpenAI
+        if len(query) < 2 or query.isdigit():
+            return "Please ask a weather question, e.g. \"Any alerts in CA?\""
+        if len(query) > MAX_QUERY_LEN:
+            return f"Please keep questions under {MAX_QUERY_LEN} characters."
+        recent = self._recent_errors.get(query)
+        if recent is not None:
+            expires, error = recent
+            if expires > time.monotonic():
+                return error
+            del self._recent_errors[query]
+        return None
+
+    async def process(self, query: str) -> AsyncIterator[str]:
+        # Trivial queries and recent failures are answered directly, and
+        # concurrent identical queries share a single backend call
+        query = query.strip()
+        direct = self._direct_response(query)
+        if direct is not None:
+            yield direct
+            return
+        key = hashlib.blake2b(query.encode()).hexdigest()
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            # An identical query is already running; share its answer
+            shared = await asyncio.shield(inflight)
+            if shared is not None:
+                yield shared
+                return
+            # Its leader stopped early; retry, so one of the waiting followers leads
+            async for piece in self.process(query):
+                yield piece
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        pieces = []
+        try:
+            async for piece in self._answer(query):
+                pieces.append(piece)
+                yield piece
+        except Exception as e:
+            self._record_error(query, f"Error: {e}")
+            fut.set_exception(e)
+            # Mark it retrieved so a future no follower joined is not logged
+            fut.exception()
+            raise
+        else:
+            fut.set_result("".join(pieces))
+        finally:
+            self._inflight.pop(key, None)
+            if not fut.done():
+                # The leader stopped early; None sends followers to answer it themselves
+                fut.set_result(None)
+
+    async def _answer(self, query: str) -> AsyncIterator[str]:
+        functions = self._functions_cache
         messages = [{"role": "user", "content": query}]
-        completion = await openai.ChatCompletion.acreate(
+        completion = await self._cached_chat(
             model="gpt-4o-mini",
+            temperature=0,
             messages=messages,
             functions=functions,
             function_call="auto",
-            max_tokens=1000
+            max_tokens=MAX_TOKENS
         )
-        msg = completion.choices[0].message
+        choice = completion.choices[0]
+        msg = choice.message
         if msg.get("function_call"):
             fn = msg.function_call.name
-            args = json.loads(msg.function_call.arguments or "{}")
+            args = orjson.loads(msg.function_call.arguments or "{}")
             tool_resp = await self.session.call_tool(fn, args)
             messages.append({"role": "assistant", "content": None, "function_call": {"name": fn, "arguments": msg.function_call.arguments}})
-            messages.append({"role": "function", "name": fn, "content": tool_resp.content})
-            followup = await openai.ChatCompletion.acreate(
-                model="gpt-4o-mini", messages=messages, max_tokens=1000
-            )
-            return followup.choices[0].message.content or ""
-        return msg.content or ""
+            content = tool_resp.content
+            if isinstance(content, list):
+                content = [i.text if hasattr(i, "text") else str(i) for i in content]
+                raw = orjson.dumps(content).decode()
+            elif isinstance(content, dict):
+                raw = orjson.dumps(content).decode()
+            else:
+                raw = str(content)
+            messages.append({"role": "function", "name": fn, "content": raw})
+            # Same functions as the first call so its prompt-cache prefix is reused
+            async for piece in self._cached_stream(
+                model="gpt-4o-mini", temperature=0, messages=messages, functions=functions,
+                function_call="none", max_tokens=MAX_TOKENS
+            ):
+                yield piece
+            return
+        yield msg.content or ""
+        if choice.finish_reason == "length":
+            # Direct answer was capped; stream the rest of it
+            async for piece in self._cached_stream(
+                model="gpt-4o-mini", temperature=0, messages=_continuation(messages, msg.content),
+                functions=functions, function_call="none", max_tokens=MAX_TOKENS,
+                continue_capped=False
+            ):
+                yield piece
+
+    async def __aexit__(self, *exc):
+        await self.cleanup()
+        # Each connection gets its own client; close its database after any queued writes
+        self._cache_io.submit(self._cache_db.close)
+        self._cache_io.shutdown(wait=False)
+
+    async def cleanup(self):
+        await self.exit_stack.aclose()
+        # A closed stack must not be reused by the next connect
+        self.exit_stack = AsyncExitStack()
+        self.session = None
+        self._functions_cache = None
+        self._functions_hash = None
+        # Errors from the old server must not outlive it
+        self._recent_errors.clear()
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
 
 class GUI:
     def __init__(self, root):
@@ -84,18 +329,30 @@ class GUI:
         self.menu.add_cascade(label="File", menu=file_menu)
         file_menu.add_command(label="Connect to Server…", command=self.choose_and_connect)
         file_menu.add_separator()
-        file_menu.add_command(label="Exit", command=root.quit)
+        file_menu.add_command(label="Exit", command=self.close)
+        root.protocol("WM_DELETE_WINDOW", self.close)
 
-        self.query_q = queue.Queue()
-        self.response_q = queue.Queue()
-        self.client = MCPClient()
+        # Lives on self._loop; the Tk thread feeds it via call_soon_threadsafe
+        self.query_q = asyncio.Queue()
+        self.response_q = queue.SimpleQueue()
+        self.client = None
         self.connected = False
-        self.root.after(100, self.check_responses)
+        self._streaming = False
+        self._main_task = None
+        self._closing = False
+
+        # One persistent event loop serves every connection
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        self.root.bind("<<McpResponse>>", self._drain_responses)
 
     def log(self, msg: str):
+        # Safe from either thread; lines are written in order by _drain_responses
+        self._post(("log", msg))
+
+    def append(self, text: str):
         self.chat.configure(state='normal')
-        self.chat.insert(tk.END, msg + '
-')
+        self.chat.insert(tk.END, text)
         self.chat.configure(state='disabled')
         self.chat.yview(tk.END)
 
@@ -104,26 +361,87 @@ class GUI:
         if not path:
             return
         self.log(f"Connecting to server: {path} ...")
-        threading.Thread(target=self.start_async_loop, args=(path,), daemon=True).start()
-
-    def start_async_loop(self, script_path):
-        asyncio.run(self.async_main(script_path))
+        asyncio.run_coroutine_threadsafe(self.async_main(path), self._loop)
 
     async def async_main(self, script_path):
+        previous, self._main_task = self._main_task, asyncio.current_task()
+        if previous is not None:
+            # Cancel the earlier session, even one stuck in connect, and give it
+            # a bounded chance to release its transport before starting anew
+            self.connected = False
+            previous.cancel()
+            await asyncio.wait({previous}, timeout=SHUTDOWN_TIMEOUT)
+        # A fresh client and queue per connection: a previous session that is still
+        # shutting down only closes its own transport, and its unanswered queries go with it
+        self.client = client = MCPClient()
+        self.query_q = asyncio.Queue()
         try:
-            await self.client.connect(script_path)
-            self.connected = True
-            self.log("✅ Connected to MCP server.")
-            while True:
-                query = await asyncio.get_event_loop().run_in_executor(None, self.query_q.get)
-                self.log(f"You: {query}")
-                try:
-                    resp = await self.client.process(query)
-                    self.response_q.put(resp)
-                except Exception as e:
-                    self.response_q.put(f"Error: {e}")
+            async with client:
+                await client.connect(script_path)
+                self.connected = True
+                self.log("✅ Connected to MCP server.")
+                await self.serve_queries()
         except Exception as e:
             self.log(f"Connection failed: {e}")
+        finally:
+            if self._main_task is asyncio.current_task():
+                self.connected = False
+
+    async def stop_session(self):
+        task = self._main_task
+        if task is not None:
+            task.cancel()
+            await asyncio.wait({task}, timeout=SHUTDOWN_TIMEOUT)
+
+    def close(self):
+        # Release the MCP server, then leave the Tk main loop from _drain_responses;
+        # waiting here would stall the Tk thread that streamed output is posted to
+        if self._closing:
+            return
+        self._closing = True
+        stopped = asyncio.run_coroutine_threadsafe(self.stop_session(), self._loop)
+        stopped.add_done_callback(lambda _: self._post(("quit", None)))
+
+    async def serve_queries(self):
+        while True:
+            # Wait for one query, then drain whatever else is already pending
+            queries = [await self.query_q.get()]
+            while not self.query_q.empty():
+                queries.append(self.query_q.get_nowait())
+            if len(queries) >= BATCH_THRESHOLD:
+                await self.answer_batch(queries)
+            else:
+                for query in queries:
+                    await self.answer(query)
+
+    async def answer(self, query):
+        self.log(f"You: {query}")
+        try:
+            async for piece in self.client.process(query):
+                self.post_response(piece)
+        except Exception as e:
+            self.post_response(f"Error: {e}")
+        # None marks the end of one streamed response
+        self.post_response(None)
+
+    async def answer_batch(self, queries):
+        async def collect(query):
+            try:
+                return "".join([piece async for piece in self.client.process(query)])
+            except Exception as e:
+                return f"Error: {e}"
+
+        for query in queries:
+            self.log(f"You: {query}")
+        # All run at once; each reply is posted as soon as it and every earlier one is done
+        tasks = [asyncio.create_task(collect(q)) for q in queries]
+        try:
+            for task in tasks:
+                self.post_response(await task)
+                self.post_response(None)
+        finally:
+            for task in tasks:
+                task.cancel()
 
     def send_query(self):
         if not self.connected:
@@ -133,13 +451,42 @@ class GUI:
         if not q:
             return
         self.entry.delete(0, tk.END)
-        self.query_q.put(q)
+        self._loop.call_soon_threadsafe(self.query_q.put_nowait, q)
+
+    def post_response(self, piece):
+        self._post(("gpt", piece))
+
+    def _post(self, item):
+        # Wake the Tk loop only when there is data
+        self.response_q.put(item)
+        self.root.event_generate("<<McpResponse>>", when="tail")
 
-    def check_responses(self):
+    def _drain_responses(self, event=None):
+        # Collect everything pending and write it with a single insert
+        buf = []
+        quitting = False
         while not self.response_q.empty():
-            resp = self.response_q.get()
-            self.log(f"GPT: {resp}")
-        self.root.after(100, self.check_responses)
+            kind, text = self.response_q.get()
+            if kind == "quit":
+                quitting = True
+            elif kind == "log":
+                if self._streaming:
+                    # Close the open GPT line; the rest of the answer resumes with a fresh prefix
+                    buf.append("\n")
+                    self._streaming = False
+                buf.append(text + "\n")
+            elif text is None:
+                buf.append("\n")
+                self._streaming = False
+            else:
+                if not self._streaming:
+                    buf.append("GPT: ")
+                    self._streaming = True
+                buf.append(text)
+        if buf:
+            self.append("".join(buf))
+        if quitting:
+            self.root.quit()
 
 if __name__ == '__main__':
     root = tk.Tk()